@@ -1,49 +1,109 @@
 # app.py
 
+import asyncio
+import functools
 import ipaddress
 import json
+import random # Added for sleep jitter
 import time  # Added for sleeping
 import os    # Added for environment variables
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Optional
 
 # Assuming 'delete' was a leftover and not used, otherwise it would need 'from requests.api import delete'
 # from requests.api import delete
+import requests # Needed for requests.exceptions in perform_sync_cycle()
 from termcolor import colored, cprint
 
-from cloudflare import createDNSRecord, deleteDNSRecord, getZoneRecords, isValidDNSRecord, getZoneId
-# getTailscaleDevice is conditionally imported later
-from tailscale import isTailscaleIP, alterHostname # alterHostname is needed by headscale.py too
+from cloudflare import buildDNSRecord, postDNSRecord, deleteDNSRecord, batchDNSRecords, getZoneRecords, isValidDNSRecord, getZoneId
+from tailscale import getTailscaleDevice, isTailscaleIP, alterHostname # alterHostname is needed by headscale.py too
+from headscale import getHeadscaleDevice
 from config import getConfig
 
 # import sys # sys was unused in the provided snippet
 
-def perform_sync_cycle(): # Renamed from main()
+# Cloudflare allows roughly 4 requests/second, so never have more calls than that in flight
+MAX_CONCURRENT_REQUESTS = 4
+# Maximum number of changes per batch request on the Cloudflare free plan
+MAX_BATCH_SIZE = 200
+
+@dataclass
+class SyncState:
+    # Carried across sync cycles by the main loop
+    cf_zone_id: Optional[str] = None
+    cf_index: dict = field(default_factory=dict) # (fqdn, content) -> Cloudflare record, as left by the last completed cycle
+    last_ts_snapshot: dict = field(default_factory=dict) # (fqdn, address) -> Tailscale/Headscale record of the last completed cycle
+    cf_dirty: bool = True # The last cycle wrote to the zone (or none ran yet), so the cached zone listing can't be trusted
+
+async def run_blocking(executor, func, *args, **kwargs):
+    # The API helpers are blocking (requests), run them on the worker threads so calls can overlap.
+    # The executor's worker count caps how many calls are in flight.
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+async def fetch_cloudflare_state(executor, config, cf_ZoneId=None, useCache=True):
+    # The zone records lookup depends on the zone id, so these two stay sequential
+    if not cf_ZoneId:
+        cf_ZoneId = await run_blocking(executor, getZoneId, config['cf-key'], config['cf-domain'])
+    if not cf_ZoneId:
+        return None, None
+    cf_records = await run_blocking(executor, getZoneRecords, config['cf-key'], config['cf-domain'], zoneId=cf_ZoneId, useCache=useCache)
+    return cf_ZoneId, cf_records
+
+async def apply_dns_changes(executor, config, cf_ZoneId, posts_list=(), deletes_list=()):
+    # Send the changes in as few batch requests as possible, falling back to one request per record if a batch fails.
+    # Returns the records Cloudflare created, so the caller can keep its view of the zone current without re-fetching it.
+    created_records = []
+    for i in range(0, len(deletes_list), MAX_BATCH_SIZE):
+        chunk = deletes_list[i:i + MAX_BATCH_SIZE]
+        if not await run_blocking(executor, batchDNSRecords, config['cf-key'], config['cf-domain'], deletes=chunk, zoneId=cf_ZoneId):
+            cprint(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Batch delete failed, retrying {len(chunk)} record(s) individually", "yellow")
+            await asyncio.gather(*[run_blocking(executor, deleteDNSRecord, config['cf-key'], config['cf-domain'], id, zoneId=cf_ZoneId) for id in chunk])
+
+    for i in range(0, len(posts_list), MAX_BATCH_SIZE):
+        chunk = posts_list[i:i + MAX_BATCH_SIZE]
+        result = await run_blocking(executor, batchDNSRecords, config['cf-key'], config['cf-domain'], posts=chunk, zoneId=cf_ZoneId)
+        if result:
+            created_records.extend(result.get('posts', []))
+        else:
+            cprint(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Batch create failed, retrying {len(chunk)} record(s) individually", "yellow")
+            created_records.extend(await asyncio.gather(*[run_blocking(executor, postDNSRecord, config['cf-key'], config['cf-domain'], payload, zoneId=cf_ZoneId) for payload in chunk]))
+
+    return created_records
+
+async def perform_sync_cycle(state): # Renamed from main()
     print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Starting DNS sync cycle...")
     config = getConfig()
     
     ts_records = [] # Initialize to ensure it's defined
+    # Kept for the whole cycle, shut down (waiting for running calls) when the cycle ends
+    executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS)
 
     try:
-        cf_ZoneId = getZoneId(config['cf-key'], config['cf-domain'])
+        # Get records depending on mode
+        if config['mode'] == "tailscale":
+            ts_fetch = run_blocking(executor, getTailscaleDevice, config['ts-key'], config['ts-client-id'], config['ts-client-secret'], config['ts-tailnet'])
+        elif config['mode'] == "headscale":
+            ts_fetch = run_blocking(executor, getHeadscaleDevice, config['hs-apikey'], config['hs-baseurl'])
+        else:
+            cprint(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] ERROR: Invalid mode '{config.get('mode', 'None')}'. Aborting sync cycle.", "red")
+            return
+
+        # Cloudflare and Tailscale/Headscale are independent, fetch both at the same time
+        # The cached zone listing is only revalidated if the previous cycle didn't write to the zone itself
+        cf_fetch = fetch_cloudflare_state(executor, config, cf_ZoneId=state.cf_zone_id, useCache=not state.cf_dirty)
+        (cf_ZoneId, cf_records_current), ts_records = await asyncio.gather(cf_fetch, ts_fetch)
+
         if not cf_ZoneId: # If getZoneId exits on error, this might not be hit, but good practice
             cprint(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] ERROR: Could not obtain Cloudflare Zone ID. Aborting sync cycle.", "red")
             return
+        state.cf_zone_id = cf_ZoneId
 
-        cf_records_current = getZoneRecords(config['cf-key'], config['cf-domain'], zoneId=cf_ZoneId)
         if cf_records_current is None: # If getZoneRecords exits on error or returns None
             cprint(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] ERROR: Could not obtain current Cloudflare records. Aborting sync cycle.", "red")
             return
 
-        # Get records depending on mode
-        if config['mode'] == "tailscale":
-            from tailscale import getTailscaleDevice # Keep conditional import
-            ts_records = getTailscaleDevice(config['ts-key'], config['ts-client-id'], config['ts-client-secret'], config['ts-tailnet'])
-        elif config['mode'] == "headscale":
-            from headscale import getHeadscaleDevice
-            ts_records = getHeadscaleDevice(config['hs-apikey'], config['hs-baseurl'])
-        else:
-            cprint(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] ERROR: Invalid mode '{config.get('mode', 'None')}'. Aborting sync cycle.", "red")
-            return
-
         if ts_records is None: # If getDevice functions return None on critical error
             cprint(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] ERROR: Failed to get records from {config['mode']}. Aborting sync cycle.", "red")
             return
@@ -54,23 +114,38 @@ def perform_sync_cycle(): # Renamed from main()
         }
 
         print(colored(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Running in ","blue")+colored(config['mode'],"red"),colored("mode", "blue")+"\n")
-        cprint(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Verifying/Adding DNS records:", "blue")
 
-        # Prepare a list of FQDNs based on current ts_records for easier lookup
+        # These only depend on the config, so compute them once instead of per record
+        cf_sub = config.get("cf-sub")
+        cf_sub_lower = cf_sub.lower() if cf_sub else ""
+        cf_domain = config['cf-domain']
+        cf_domain_lower = cf_domain.lower()
+        expected_ending = ("." + cf_sub_lower if cf_sub_lower else "") + "." + cf_domain_lower # The FQDN suffix of every record this script manages
+
+        # Prepare a list of FQDNs based on current ts_records for easier lookup, keyed by (fqdn, address) like cf_index
         current_ts_fqdns_ips = {}
         for ts_rec in ts_records:
-            _sub = "." + config.get("cf-sub").lower() if config.get("cf-sub") else ""
             _hostname_part = alterHostname(ts_rec['hostname'].split('.')[0].lower()) # Apply prefix/postfix here
-            _tsfqdn = _hostname_part + _sub + "." + config['cf-domain'].lower()
-            current_ts_fqdns_ips[_tsfqdn + "_" + ts_rec['address']] = {'fqdn': _tsfqdn, 'address': ts_rec['address'], 'original_hostname': ts_rec['hostname']}
+            _tsfqdn = _hostname_part + expected_ending
+            current_ts_fqdns_ips[(_tsfqdn, ts_rec['address'])] = {'fqdn': _tsfqdn, 'address': ts_rec['address'], 'original_hostname': ts_rec['hostname']}
+
+        # Index the Cloudflare records by (name, content) so each lookup below is a dict hit instead of a scan of the zone
+        cf_index = {(c['name'].lower(), c['content']): c for c in cf_records_current}
 
+        # If neither side changed since the last completed cycle, that cycle's result still holds and there is nothing to write
+        if current_ts_fqdns_ips == state.last_ts_snapshot and cf_index.keys() == state.cf_index.keys():
+            cprint(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] No changes in {config['mode']} or Cloudflare since the last sync cycle.", "green")
+            state.cf_dirty = False
+            return
 
+        cprint(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Verifying/Adding DNS records:", "blue")
+        posts_list = []
         for key, ts_detail in current_ts_fqdns_ips.items():
             tsfqdn = ts_detail['fqdn']
             ts_address = ts_detail['address']
             original_hostname = ts_detail['original_hostname'] # For isValidDNSRecord if it checks non-altered
 
-            if any(c['name'].lower() == tsfqdn and c['content'] == ts_address for c in cf_records_current):
+            if (tsfqdn, ts_address) in cf_index:
                 print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] [{colored('UP-TO-DATE', 'green')}]: {tsfqdn} -> {ts_address}")
             else:
                 ip = ipaddress.ip_address(ts_address)
@@ -78,31 +153,28 @@ def perform_sync_cycle(): # Renamed from main()
                 # The original script used ts_rec['hostname'] which is pre-alterHostname.
                 if isValidDNSRecord(original_hostname):
                     print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] [{colored('ADDING', 'yellow')}]: {tsfqdn} -> {ts_address}")
-                    # createDNSRecord expects the non-prefixed/postfixed hostname for the 'name' param if subdomain is also passed
-                    createDNSRecord(config['cf-key'], config['cf-domain'], original_hostname.split('.')[0].lower(), records_typemap[ip.version], ts_address, subdomain=config.get("cf-sub"), zoneId=cf_ZoneId)
+                    # buildDNSRecord expects the non-prefixed/postfixed hostname for the 'name' param if subdomain is also passed
+                    posts_list.append(buildDNSRecord(cf_domain, original_hostname.split('.')[0].lower(), records_typemap[ip.version], ts_address, subdomain=cf_sub))
                 else:
                     print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] [{colored('SKIPPING INVALID HOSTNAME', 'red')}]: Original hostname '{original_hostname}' for {tsfqdn} -> {ts_address}")
+        state.cf_dirty = bool(posts_list)
+        # Cloudflare returns the created records, add them locally instead of re-fetching the whole zone
+        for new_record in await apply_dns_changes(executor, config, cf_ZoneId, posts_list=posts_list):
+            cf_index[(new_record['name'].lower(), new_record['content'])] = new_record
 
         cprint(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Cleaning up stale DNS records:", "blue")
-        # Re-fetch Cloudflare records as they might have changed by the 'ADDING' step
-        cf_records_for_cleanup = getZoneRecords(config['cf-key'], config['cf-domain'], zoneId=cf_ZoneId)
-        if cf_records_for_cleanup is None:
-            cprint(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] ERROR: Could not fetch Cloudflare records for cleanup. Skipping cleanup.", "red")
-            return
-
-        for cf_rec in cf_records_for_cleanup:
-            cf_rec_fqdn = cf_rec['name'].lower()
-            cf_rec_content = cf_rec['content']
+        deletes_list = []
+        deleted_keys = []
+        for (cf_rec_fqdn, cf_rec_content), cf_rec in cf_index.items():
             
             # Check if this Cloudflare record (FQDN + IP) is in our current Tailscale/Headscale list
-            if (cf_rec_fqdn + "_" + cf_rec_content) in current_ts_fqdns_ips:
+            if (cf_rec_fqdn, cf_rec_content) in current_ts_fqdns_ips:
                 # print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] [{colored('IN USE', 'green')}]: {cf_rec_fqdn} -> {cf_rec_content}")
                 continue # This exact record (name and IP) is current and correct
 
             # If we reach here, the DNS record name+ip combo is not current.
             # Now check if the name *structure* matches what this script *would* manage
             # to avoid deleting unrelated records.
-            expected_ending = (("." + config.get("cf-sub").lower() if config.get("cf-sub") else "") + "." + config['cf-domain'].lower())
             if not cf_rec_fqdn.endswith(expected_ending):
                 continue # Not a record this script would manage (wrong subdomain/domain)
 
@@ -121,7 +193,16 @@ def perform_sync_cycle(): # Renamed from main()
             # If it looks like one of our records (based on domain/subdomain) and has a Tailscale IP
             # but does not match any current FQDN+IP combo from Headscale, then it's stale.
             print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] [{colored('DELETING STALE', 'yellow')}]: {cf_rec_fqdn} -> {cf_rec_content}")
-            deleteDNSRecord(config['cf-key'], config['cf-domain'], cf_rec['id'], zoneId=cf_ZoneId)
+            deletes_list.append(cf_rec['id'])
+            deleted_keys.append((cf_rec_fqdn, cf_rec_content))
+        state.cf_dirty = state.cf_dirty or bool(deletes_list)
+        await apply_dns_changes(executor, config, cf_ZoneId, deletes_list=deletes_list)
+        for key in deleted_keys:
+            del cf_index[key]
+
+        # Only remember the result once the whole cycle went through
+        state.cf_index = cf_index
+        state.last_ts_snapshot = current_ts_fqdns_ips
 
     except requests.exceptions.RequestException as e: # Catch network errors for API calls
         cprint(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] ERROR: Network error during sync cycle: {e}", "red")
@@ -131,6 +212,8 @@ def perform_sync_cycle(): # Renamed from main()
         cprint(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] ERROR: An unexpected error occurred: {e}", "red")
         import traceback
         traceback.print_exc() # Print full traceback for unexpected errors
+    finally:
+        executor.shutdown(wait=True)
 
 if __name__ == '__main__':
     sync_interval_minutes_str = os.environ.get('SYNC_INTERVAL_MINUTES', '15') # Default to 15 minutes
@@ -143,10 +226,29 @@ if __name__ == '__main__':
         print(colored(f"Warning: Invalid SYNC_INTERVAL_MINUTES value '{sync_interval_minutes_str}'. Using default 15 minutes.", "yellow"))
         sync_interval_minutes = 15
 
+    sync_jitter_pct_str = os.environ.get('SYNC_JITTER_PCT', '15') # Default to +/-15% of the interval
+    try:
+        sync_jitter_pct = int(sync_jitter_pct_str)
+        if not 0 <= sync_jitter_pct <= 100:
+            print(colored(f"Warning: SYNC_JITTER_PCT must be between 0 and 100. Using default 15 percent.", "yellow"))
+            sync_jitter_pct = 15
+    except ValueError:
+        print(colored(f"Warning: Invalid SYNC_JITTER_PCT value '{sync_jitter_pct_str}'. Using default 15 percent.", "yellow"))
+        sync_jitter_pct = 15
+
     sync_interval_seconds = sync_interval_minutes * 60
-    cprint(f"DNS Sync script started. Sync interval: {sync_interval_minutes} minutes.", "green")
+    sync_jitter = sync_jitter_pct / 100
+    cprint(f"DNS Sync script started. Sync interval: {sync_interval_minutes} minutes (jitter: {sync_jitter_pct}%).", "green")
+
+    # Randomize the start and every sleep so instances started at the same time don't all hit the APIs together
+    startup_delay_seconds = random.uniform(0, sync_interval_seconds * sync_jitter)
+    if startup_delay_seconds:
+        cprint(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Delaying first sync cycle by {startup_delay_seconds:.0f} seconds...", "blue")
+        time.sleep(startup_delay_seconds)
 
+    state = SyncState()
     while True:
-        perform_sync_cycle() # Call the main sync logic
-        cprint(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Sync cycle finished. Sleeping for {sync_interval_minutes} minutes...", "blue")
-        time.sleep(sync_interval_seconds)
+        asyncio.run(perform_sync_cycle(state)) # Call the main sync logic
+        sleep_seconds = sync_interval_seconds * random.uniform(1 - sync_jitter, 1 + sync_jitter)
+        cprint(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Sync cycle finished. Sleeping for {sleep_seconds / 60:.1f} minutes...", "blue")
+        time.sleep(sleep_seconds)
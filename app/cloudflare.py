@@ -1,15 +1,50 @@
-import requests, json, re
+import functools, requests, json, re, threading, time
 
 from termcolor import cprint, colored
+from requests.adapters import HTTPAdapter
 from requests.models import Response
+from urllib3.util.retry import Retry
+
+# One pooled session for all Cloudflare calls, so connections (and their TLS handshakes) are reused.
+# Throttled (429) and gateway errors are retried with backoff, honouring Retry-After. POST is not in
+# urllib3's default retry methods, so record creation is never sent twice.
+_session = requests.Session()
+_session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 502, 503, 504], raise_on_status=False)))
+
+# Cloudflare allows 1200 requests per 5 minutes, i.e. 4 per second on average. Requests may still overlap,
+# but they are started at most this often, no matter how many threads call into this module.
+MAX_REQUESTS_PER_SECOND = 4
+_rateLimitLock = threading.Lock()
+_nextRequestAt = 0.0
+
+def _request(method, url, **kwargs):
+    global _nextRequestAt
+    with _rateLimitLock:
+        now = time.monotonic()
+        wait = _nextRequestAt - now
+        _nextRequestAt = max(now, _nextRequestAt) + 1 / MAX_REQUESTS_PER_SECOND
+    if wait > 0:
+        time.sleep(wait)
+    return _session.request(method, url, **kwargs)
+
+# domain -> zone id, a zone's id never changes so it only needs to be looked up once per process
+_zoneIdCache = {}
 
 def getZoneId(token, domain):
+    if domain not in _zoneIdCache:
+        zoneId = _fetchZoneId(token, domain)
+        if not zoneId:
+            return zoneId
+        _zoneIdCache[domain] = zoneId
+    return _zoneIdCache[domain]
+
+def _fetchZoneId(token, domain):
     url = "https://api.cloudflare.com/client/v4/zones"
     payload={}
     headers = {
     'Authorization': "Bearer {}".format(token)
     }
-    response = requests.request("GET", url, headers=headers, data=payload)
+    response = _request("GET", url, headers=headers, data=payload)
     data = json.loads(response.text)
 
     if data['success']:
@@ -22,17 +57,25 @@ def getZoneId(token, domain):
         exit(1) # Exit with a non-zero status code
 
 
-def getZoneRecords(token, domain, hostname=False, zoneId=False):
-    if zoneId != False:
-        url = "https://api.cloudflare.com/client/v4/zones/{zone_identifier}/dns_records?per_page=150".format(zone_identifier=zoneId)
-    else:
-        url = "https://api.cloudflare.com/client/v4/zones/{zone_identifier}/dns_records?per_page=150".format(zone_identifier=getZoneId(token, domain))
+# zoneId -> {'etag': ..., 'records': [...]}, used to revalidate the zone listing between sync cycles
+_zoneRecordsCache = {}
+
+def getZoneRecords(token, domain, hostname=False, zoneId=False, useCache=True):
+    if zoneId == False:
+        zoneId = getZoneId(token, domain)
+    url = "https://api.cloudflare.com/client/v4/zones/{zone_identifier}/dns_records?per_page=150".format(zone_identifier=zoneId)
     payload={}
     headers = {
     'Authorization': "Bearer {}".format(token)
     }
-
-    response = requests.request("GET", url, headers=headers, data=payload)
+    cached = _zoneRecordsCache.get(zoneId)
+    if useCache and cached:
+        headers['If-None-Match'] = cached['etag']
+
+    response = _request("GET", url, headers=headers, data=payload)
+    if response.status_code == 304 and cached:
+        # Nothing changed since the last listing, hand out a copy so callers can't alter the cache
+        return list(cached['records'])
     data = json.loads(response.text)
 
     output = []
@@ -42,36 +85,45 @@ def getZoneRecords(token, domain, hostname=False, zoneId=False):
             if record['type'] in ['A', 'AAAA']:
                 #print("{name} {ttl} in {type} {content}".format(name=record['name'], ttl=record['ttl'], type=record['type'], content=record['content']))
                 output.append(record)
+        if response.headers.get('ETag'):
+            _zoneRecordsCache[zoneId] = {'etag': response.headers['ETag'], 'records': list(output)}
+        else:
+            _zoneRecordsCache.pop(zoneId, None)
         return output
     else:
         exit(colored("getZoneRecords() - error\n{}".format(json.dumps(data['errors'], indent=2)), "red"))
 
-def createDNSRecord(token, domain, name, type, content, subdomain=None, zoneId=False, priority=False, ttl=120):
-    if zoneId != False:
-        url = "https://api.cloudflare.com/client/v4/zones/{zone_identifier}/dns_records".format(zone_identifier=zoneId)
-    else:
-        url = "https://api.cloudflare.com/client/v4/zones/{zone_identifier}/dns_records".format(zone_identifier=getZoneId(token, domain))
+def buildDNSRecord(domain, name, type, content, subdomain=None, ttl=120):
     if subdomain:
         fqdn = name+"."+subdomain+"."+domain
     else:
         fqdn = name+"."+domain
-        
-    payload={
+
+    return {
         'type': type,
         'name': fqdn,
         'content': content,
         'ttl': ttl
     }
+
+def createDNSRecord(token, domain, name, type, content, subdomain=None, zoneId=False, priority=False, ttl=120):
+    return postDNSRecord(token, domain, buildDNSRecord(domain, name, type, content, subdomain=subdomain, ttl=ttl), zoneId=zoneId)
+
+def postDNSRecord(token, domain, payload, zoneId=False):
+    if zoneId != False:
+        url = "https://api.cloudflare.com/client/v4/zones/{zone_identifier}/dns_records".format(zone_identifier=zoneId)
+    else:
+        url = "https://api.cloudflare.com/client/v4/zones/{zone_identifier}/dns_records".format(zone_identifier=getZoneId(token, domain))
     headers = {
         'Authorization': "Bearer {}".format(token)
     }
 
-    response = requests.request("POST", url, headers=headers, data=json.dumps(payload))
+    response = _request("POST", url, headers=headers, data=json.dumps(payload))
     data = json.loads(response.text)
 
     if data['success'] == True:
         print("--> [CLOUDFLARE] [{code}] {msg}".format(code=response.status_code, msg=colored('record created', "green")))
-        return True
+        return data['result']
     else:
         cprint("[ERROR]", 'red')
         exit("createDNSRecord():  "+json.dumps(data['errors'], indent=2))
@@ -84,13 +136,41 @@ def deleteDNSRecord(token, domain, id, zoneId=False):
     headers = {
         'Authorization': "Bearer {}".format(token)
     }
-    response = requests.request("DELETE", url, headers=headers)
+    response = _request("DELETE", url, headers=headers)
     data = json.loads(response.text)
     print("--> [CLOUDFLARE] [{code}] {msg}".format(code=response.status_code, msg=colored('record deleted', "green")))
 
+def batchDNSRecords(token, domain, posts=None, deletes=None, patches=None, zoneId=False):
+    # Cloudflare applies all operations of a batch in a single transaction (deletes, patches, then posts)
+    if zoneId != False:
+        url = "https://api.cloudflare.com/client/v4/zones/{zone_identifier}/dns_records/batch".format(zone_identifier=zoneId)
+    else:
+        url = "https://api.cloudflare.com/client/v4/zones/{zone_identifier}/dns_records/batch".format(zone_identifier=getZoneId(token, domain))
+    payload = {
+        'posts': posts or [],
+        'deletes': [{'id': id} for id in (deletes or [])],
+        'patches': patches or []
+    }
+    headers = {
+        'Authorization': "Bearer {}".format(token)
+    }
+
+    response = _request("POST", url, headers=headers, data=json.dumps(payload))
+    data = json.loads(response.text)
+
+    if data['success'] == True:
+        print("--> [CLOUDFLARE] [{code}] {msg}".format(code=response.status_code, msg=colored('batch applied ({posts} created, {deletes} deleted, {patches} updated)'.format(posts=len(payload['posts']), deletes=len(payload['deletes']), patches=len(payload['patches'])), "green")))
+        return data['result']
+    else:
+        # Unlike the single record helpers this does not exit, so the caller can fall back to them
+        cprint("batchDNSRecords() - error\n{}".format(json.dumps(data['errors'], indent=2)), "red")
+        return False
+
+_validDNSRecordRegex = re.compile(r"^([a-zA-Z]|\d|-|\.)*$")
+
+@functools.lru_cache(maxsize=2048)
 def isValidDNSRecord(name):
-    regex = "^([a-zA-Z]|\d|-|\.)*$"
-    return re.match(regex, name)
+    return _validDNSRecordRegex.match(name)
 
 
 
@@ -1,4 +1,5 @@
 import requests, json
+import functools
 import ipaddress
 from requests.auth import HTTPBasicAuth
 from oauthlib.oauth2 import BackendApplicationClient
@@ -33,23 +34,19 @@ def getTailscaleDevice(apikey, clientid, clientsecret, tailnet):
     else:
         exit(colored("getTailscaleDevice() - {status}, {error}".format(status=str(response.status_code), error=data['message']), "red"))
 
+# Address ranges Tailscale (and Headscale) hand out to nodes
+_tailscaleNetworks = (ipaddress.ip_network('100.64.0.0/10'), ipaddress.ip_network('fd7a:115c:a1e0::/48'))
+
+@functools.lru_cache(maxsize=4096)
 def isTailscaleIP(ip):
+    # Cached on the address string, the same records are checked again every sync cycle
     ip = ipaddress.ip_address(ip)
+    # Membership of a network with a different IP version is simply False
+    return any(ip in network for network in _tailscaleNetworks)
 
-    if (ip.version == 6):
-        if (ip in ipaddress.IPv6Network('fd7a:115c:a1e0::/48')):
-            return True
-        else:
-            return False
-    elif (ip.version == 4):
-        if (ip in ipaddress.IPv4Network('100.64.0.0/10')):
-            return True
-        else:
-            return False
-    else:
-        exit("isTailscaleIP(): - unknown IP version")
-
+@functools.lru_cache(maxsize=2048)
 def alterHostname(hostname):
+    # Cached because getConfig() re-reads the whole config on every call; prefix/postfix changes need a restart
     from config import getConfig
     config = getConfig()
     pre = config.get("prefix", "")